@@ -28,6 +28,15 @@ class DatabaseConfig:
     port: int = int(os.getenv('DATABASE_PORT'))
     prefix: str = os.getenv('DATABASE_PREFIX')
 
+@dataclass
+class TracingConfig:
+    enabled: bool = os.getenv('TRACING_ENABLED', 'false').lower() == 'true'
+    slow_request_ms: float = float(os.getenv('SLOW_REQUEST_MS', '500'))
+    server_timing: bool = os.getenv('SERVER_TIMING_ENABLED', 'false').lower() == 'true'
+    profiler_enabled: bool = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+    profiler_token: str = os.getenv('PROFILER_TOKEN', '')
+    profiler_max_seconds: float = float(os.getenv('PROFILER_MAX_SECONDS', '30'))
+
 @dataclass
 class Config:
 
@@ -36,12 +45,16 @@ class Config:
 
     payments: PaymentsConfig = None
     database: DatabaseConfig = None
+    tracing: TracingConfig = None
     tz_info: datetime = timezone(timedelta(hours=3.0))
 
     words_ttl = timedelta(minutes=30)
+    stats_ttl = timedelta(hours=24)
+    stats_reconcile_interval = timedelta(minutes=30)
 
     def __post_init__(self):
         if not self.payments: self.payments = PaymentsConfig()
         if not self.database: self.database = DatabaseConfig()
+        if not self.tracing: self.tracing = TracingConfig()
 
 config = Config()
\ No newline at end of file
@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import secrets
+import threading
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.params import Query
+from fastapi.responses import PlainTextResponse
+
+from src.config import config
+from src.tracing import sample_stacks, render_folded
+
+logger = logging.getLogger('gateway')
+
+router = APIRouter(prefix='/debug')
+
+_profile_lock = asyncio.Lock()
+
+
+@router.get('/profile', response_class=PlainTextResponse)
+async def profile_handler(
+        seconds: float = Query(
+            10.0, gt=0, le=config.tracing.profiler_max_seconds,
+            description="Длительность окна профилирования в секундах"
+        ),
+        interval_ms: float = Query(5.0, ge=1, le=1000, description="Интервал между сэмплами в мс"),
+        x_profiler_token: Optional[str] = Header(None, description="Секрет из PROFILER_TOKEN"),
+):
+    """ Сэмплирует стек event loop и возвращает его в folded-формате для flamegraph """
+    # Без заданного PROFILER_TOKEN профилировщик закрыт для всех
+    token = config.tracing.profiler_token
+    if not token or not x_profiler_token or \
+            not secrets.compare_digest(x_profiler_token.encode(), token.encode()):
+        raise HTTPException(status_code=403, detail='Forbidden')
+
+    if _profile_lock.locked():
+        raise HTTPException(status_code=409, detail='Profiling is already in progress')
+
+    async with _profile_lock:
+        loop_thread_id = threading.get_ident()
+        logger.info(f'Profiling event loop for {seconds}s every {interval_ms}ms')
+        stacks = await asyncio.to_thread(
+            sample_stacks, loop_thread_id, seconds, interval_ms / 1000
+        )
+
+    return render_folded(stacks)
@@ -3,49 +3,193 @@ from json import loads, dumps
 from typing import Dict, Optional
 
 import httpx
-from fastapi import APIRouter, HTTPException, Response
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Response
 from fastapi.params import Query
 from redis.asyncio import Redis as aioredis
 
 from src.config import config
 from src.models import Word
+from src.tracing import TracedRoute, span
 
 logger = logging.getLogger('gateway')
 
 redis = aioredis.from_url("redis://redis", decode_responses=True)
 
-router = APIRouter(prefix='/api')
+router = APIRouter(prefix='/api', route_class=TracedRoute)
 
 
 DATABASE_BASE_URL = f"http://{config.database.host}:{config.database.port}"
 
+# Применяет приращения к счётчикам статистики, только если она уже в кэше:
+# частичный хэш без базовых значений хуже, чем промах и запрос в database-сервис.
+# KEYS: хэш статистики, его версия.
+# ARGV: TTL версии, приращение, поле видимости (public/private), часть речи (необязательно).
+# Версия растёт при каждой записи, даже без хэша в кэше, чтобы _replace_stats
+# не затёр её снимком database-сервиса, снятым раньше.
+# Часть речи приходит от клиента, поэтому не может совпадать с общими счётчиками,
+# а поле, которого нет в ответе database-сервиса, сбрасывает хэш до следующей сверки
+_incr_stats = redis.register_script("""
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local fields = {'total', ARGV[3]}
+local part_of_speech = ARGV[4]
+if part_of_speech then
+    if part_of_speech == 'total' or part_of_speech == 'public' or part_of_speech == 'private' then
+        redis.call('DEL', KEYS[1])
+        return -1
+    end
+    table.insert(fields, part_of_speech)
+end
+for _, field in ipairs(fields) do
+    if redis.call('HEXISTS', KEYS[1], field) == 0 then
+        redis.call('DEL', KEYS[1])
+        return -1
+    end
+end
+for _, field in ipairs(fields) do
+    redis.call('HINCRBY', KEYS[1], field, ARGV[2])
+end
+return 1
+""")
+
+# Заменяет хэш статистики снимком database-сервиса, если с момента чтения версии
+# никто не менял счётчики. Иначе запись пропускается: следующее чтение повторит сверку.
+# KEYS: хэш статистики, его версия. ARGV: ожидаемая версия, TTL хэша, пары поле-значение
+_replace_stats = redis.register_script("""
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if #ARGV > 2 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+""")
+
+
+def _stats_deltas(part_of_speech: Optional[str], is_public: bool, sign: int) -> list:
+    """ Аргументы для _incr_stats: приращение, поле видимости и часть речи """
+    deltas = [sign, 'public' if is_public else 'private']
+    if part_of_speech:
+        deltas.append(part_of_speech)
+    return deltas
+
+
+def _deleted_word_deltas(word: Optional[dict]) -> Optional[list]:
+    """ Приращения для удаляемого слова по его записи из words:{user_id} """
+    if not isinstance(word, dict) or 'is_public' not in word:
+        return None
+    return _stats_deltas(word.get('part_of_speech'), word['is_public'], -1)
+
+
+def _stats_keys(user_id: int) -> list:
+    return [f'stats:{user_id}', f'stats:{user_id}:ver']
+
+
+async def _apply_stats(user_id: int, deltas: list):
+    """ Атомарно применяет приращения _stats_deltas к счётчикам пользователя """
+    ttl = int(config.stats_ttl.total_seconds())
+    if await _incr_stats(keys=_stats_keys(user_id), args=[ttl, *deltas]) == -1:
+        # Частые сбросы значат, что имена полей не совпадают с ответом database-сервиса
+        logger.warning(
+            f'Stats for {user_id} reset: fields {["total", *deltas[1:]]} '
+            f'are reserved or missing in cached stats'
+        )
+
+
+async def _drop_stats(user_id: int):
+    """ Сбрасывает счётчики и версию, чтобы уже начатая сверка их не восстановила """
+    key, ver_key = _stats_keys(user_id)
+    async with redis.pipeline(transaction=True) as pipe:
+        await pipe.delete(key).incr(ver_key).expire(ver_key, config.stats_ttl).execute()
+
+
+async def _fetch_words(user_id: int) -> httpx.Response:
+    async with httpx.AsyncClient() as client:
+        url = DATABASE_BASE_URL + config.database.prefix + f'/words?user_id={user_id}'
+        with span('upstream'):
+            return await client.get(url=url)
+
+
+async def _cache_words(user_id: int, words: dict):
+    key = f'words:{user_id}'
+    with span('serialize'):
+        mapping = {str(key): dumps(val) for key, val in words.items()}
+    with span('cache'):
+        await redis.hset(key, mapping=mapping)
+        await redis.expire(key, config.words_ttl)
+
+
+async def _fetch_stats(user_id: int) -> httpx.Response:
+    async with httpx.AsyncClient() as client:
+        url = DATABASE_BASE_URL + config.database.prefix + f'/words/stats?user_id={user_id}'
+        with span('upstream'):
+            return await client.get(url=url)
+
+
+async def _stats_version(user_id: int) -> str:
+    """ Версия счётчиков; читается до запроса снимка в database-сервис """
+    return await redis.get(f'stats:{user_id}:ver') or '0'
+
+
+async def _store_stats(user_id: int, stats: dict, version: str):
+    """
+    Заменяет счётчики пользователя значениями из database-сервиса,
+    если они не менялись с момента чтения version. Пустой снимок удаляет хэш.
+    """
+    args = [version, int(config.stats_ttl.total_seconds())]
+    for field, value in stats.items():
+        args += [field, value]
+    if not await _replace_stats(keys=_stats_keys(user_id), args=args):
+        logger.info(f'Stats for {user_id} changed during fetch, skipping store')
+
+
+async def _reconcile_stats(user_id: int):
+    """ Сверяет счётчики с database-сервисом и исправляет накопившийся дрейф """
+    if not await redis.set(f'stats:{user_id}:reconcile', 1, nx=True, ex=60):
+        return
+
+    try:
+        version = await _stats_version(user_id)
+        resp = await _fetch_stats(user_id)
+        if resp.status_code != 200:
+            logger.warning(f'Failed to reconcile stats for {user_id}: {resp.status_code}')
+        else:
+            # Пустой снимок: у пользователя не осталось слов, старые счётчики удаляются
+            await _store_stats(user_id, resp.json() or {}, version)
+
+    except Exception as e:
+        logger.error(f'Error in _reconcile_stats: {e}')
+
+
 @router.get('/words')
 async def get_words_handler(
         user_id: int = Query(..., description="User ID")
 ):
     """ Перенаправляет запрос на получение слова пользователя """
     try:
-        cached = await redis.hgetall(f'words:{user_id}')
+        with span('cache'):
+            cached = await redis.hgetall(f'words:{user_id}')
         if cached:
-            return { key: loads(val) for key, val in cached.items() }
+            with span('serialize'):
+                return { key: loads(val) for key, val in cached.items() }
 
-        async with httpx.AsyncClient() as client:
-            url = DATABASE_BASE_URL + config.database.prefix + f'/words?user_id={user_id}'
-            resp = await client.get(url=url)
-            if resp.status_code == 200:
-                words = resp.json()
-                if words:
-                    key = f'words:{user_id}'
-                    mapping = {str(key): dumps(val) for key, val in words.items()}
-                    await redis.hset(key, mapping=mapping)
-                    await redis.expire(key, config.words_ttl)
+        resp = await _fetch_words(user_id)
+        if resp.status_code == 200:
+            words = resp.json()
+            if words:
+                await _cache_words(user_id, words)
 
-                return words
+            return words
 
-            else:
-                raise HTTPException(
-                    status_code=resp.status_code, detail=resp.text
-                )
+        else:
+            raise HTTPException(
+                status_code=resp.status_code, detail=resp.text
+            )
     except Exception as e:
         logger.error(f'Error in get_words_handler: {e}')
         raise HTTPException(status_code=500, detail='Internal Server Error')
@@ -57,14 +201,21 @@ async def save_word_handler(word_data: Word):
         async with httpx.AsyncClient() as client:
             url = DATABASE_BASE_URL + config.database.prefix + '/words'
             headers = {'content-type': 'application/json'}
-            resp = await client.post(
-                url=url,
-                headers=headers,
-                content=word_data.model_dump_json()
-            )
+            with span('serialize'):
+                content = word_data.model_dump_json()
+            with span('upstream'):
+                resp = await client.post(
+                    url=url,
+                    headers=headers,
+                    content=content
+                )
             if resp.status_code == 200:
                 user_id=word_data.user_id
-                await redis.delete(f'words:{user_id}', f'stats:{user_id}')
+                with span('cache'):
+                    await redis.delete(f'words:{user_id}')
+                    await _apply_stats(
+                        user_id, _stats_deltas(word_data.part_of_speech, word_data.is_public, 1)
+                    )
                 return Response(status_code=200, content=resp.text)
 
             return Response(content=resp.text, status_code=resp.status_code)
@@ -80,11 +231,26 @@ async def api_delete_word_handler(
     word_id: int = Query(..., description="Word ID which it goes by in DB"),
 ):
     try:
+        # Часть речи и видимость нужны до удаления, после него их уже не узнать.
+        # Без закэшированной статистики применять их не к чему
+        with span('cache'):
+            async with redis.pipeline(transaction=False) as pipe:
+                stats_cached, cached_word = await pipe.exists(
+                    f'stats:{user_id}'
+                ).hget(f'words:{user_id}', str(word_id)).execute()
+        word = loads(cached_word) if stats_cached and cached_word is not None else None
+
         async with httpx.AsyncClient() as client:
             url = DATABASE_BASE_URL + config.database.prefix + f'/words?user_id={user_id}&word_id={word_id}'
-            resp = await client.delete(url=url)
+            with span('upstream'):
+                resp = await client.delete(url=url)
             if resp.status_code == 200:
-                await redis.delete(f'words:{user_id}', f'stats:{user_id}')
+                with span('cache'):
+                    await redis.hdel(f'words:{user_id}', str(word_id))
+                    if deltas := _deleted_word_deltas(word):
+                        await _apply_stats(user_id, deltas)
+                    else:
+                        await _drop_stats(user_id)
                 return 200
             else:
                 raise HTTPException(status_code=resp.status_code, detail=resp.text)
@@ -102,9 +268,11 @@ async def api_search_word_handler(
     try:
         # Создаем Redis key без user_id если он None
         redis_key = f'words:{word}:{user_id if user_id else "all"}'
-        cached = await redis.hgetall(redis_key)
+        with span('cache'):
+            cached = await redis.hgetall(redis_key)
         if cached:
-            return {str(key): loads(val) for key, val in cached.items()}
+            with span('serialize'):
+                return {str(key): loads(val) for key, val in cached.items()}
 
         # Ищем слово от пользователя
         async with httpx.AsyncClient() as client:
@@ -116,13 +284,16 @@ async def api_search_word_handler(
                 url = DATABASE_BASE_URL + config.database.prefix + \
                     f'/words/search?word={word}'
             
-            resp = await client.get(url=url)
+            with span('upstream'):
+                resp = await client.get(url=url)
             if resp.status_code == 200:
                 words = resp.json()
                 if words:
-                    mapping = {key: dumps(val) for key, val in words.items()}
-                    await redis.hset(redis_key, mapping=mapping)
-                    await redis.expire(redis_key, config.words_ttl)
+                    with span('serialize'):
+                        mapping = {key: dumps(val) for key, val in words.items()}
+                    with span('cache'):
+                        await redis.hset(redis_key, mapping=mapping)
+                        await redis.expire(redis_key, config.words_ttl)
 
                 logger.info(f'words: {words}')
                 return words
@@ -136,29 +307,40 @@ async def api_search_word_handler(
 
 @router.get("/words/stats")
 async def api_stats_handler(
+        background_tasks: BackgroundTasks,
         user_id: int = Query(..., description="USer ID")
 ):
-    """ Обработчик статистики слов пользователя """
-    cached = await redis.hgetall(f'stats:{user_id}')
+    """
+    Обработчик статистики слов пользователя.
+    Счётчики поддерживаются в Redis при сохранении и удалении слов,
+    а раз в stats_reconcile_interval сверяются с database-сервисом в фоне.
+    """
+    key = f'stats:{user_id}'
+    with span('cache'):
+        async with redis.pipeline(transaction=False) as pipe:
+            cached, ttl = await pipe.hgetall(key).ttl(key).execute()
     if cached:
+        age = config.stats_ttl.total_seconds() - ttl
+        if age >= config.stats_reconcile_interval.total_seconds():
+            background_tasks.add_task(_reconcile_stats, user_id)
         return cached
 
     try:
-        async with httpx.AsyncClient() as client:
-            url = DATABASE_BASE_URL + config.database.prefix + f'/words/stats?user_id={user_id}'
-            resp = await client.get(url=url)
-            if resp.status_code == 200:
-                stats = resp.json()
-                if stats:
-                    await redis.hset(f'stats:{user_id}', mapping=stats)
-                    await redis.expire(f'stats:{user_id}', config.words_ttl)
+        with span('cache'):
+            version = await _stats_version(user_id)
+        resp = await _fetch_stats(user_id)
+        if resp.status_code == 200:
+            stats = resp.json()
+            if stats:
+                with span('cache'):
+                    await _store_stats(user_id, stats, version)
 
-                return stats
+            return stats
 
-            else:
-                raise HTTPException(
-                    status_code=resp.status_code, detail=resp.text
-                )
+        else:
+            raise HTTPException(
+                status_code=resp.status_code, detail=resp.text
+            )
 
     except Exception as e:
         logger.error(f"Error in api_stats_handler: {str(e)}")
@@ -9,12 +9,13 @@ from redis.asyncio import Redis as aioredis
 
 from src.config import config
 from src.models import Payment
+from src.tracing import TracedRoute, span
 
 logger = logging.getLogger('gateway')
 
 redis = aioredis.from_url("redis://redis")
 
-router = APIRouter(prefix='/api')
+router = APIRouter(prefix='/api', route_class=TracedRoute)
 
 PAYMENT_BASE_URL = f"http://{config.payments.host}:{config.payments.port}"
 
@@ -28,7 +29,8 @@ async def test_connection():
                   f"{config.database.prefix}/health"
 
             logger.info(f"Testing connection to: {url}")
-            response = await client.get(url, timeout=5.0)
+            with span('upstream'):
+                response = await client.get(url, timeout=5.0)
             return {
                 "status": "success",
                 "database_url": url,
@@ -47,21 +49,26 @@ async def test_connection():
 @router.get("/due_to")
 async def get_users_due_to_handler(user_id = Query(..., description="User ID")):
     try:
-        cached = await redis.hgetall(f'due_to:{user_id}')
+        with span('cache'):
+            cached = await redis.hgetall(f'due_to:{user_id}')
         if cached:
-            return { key: loads(val) for key, val in cached.items() }
+            with span('serialize'):
+                return { key: loads(val) for key, val in cached.items() }
 
         async with httpx.AsyncClient() as client:
 
             url = PAYMENT_BASE_URL + config.payments.handler.prefix + \
                   f'/due_to?user_id={user_id}'
 
-            response = await client.get(url=url, timeout=5.0)
+            with span('upstream'):
+                response = await client.get(url=url, timeout=5.0)
             if response.status_code == 200:
                 if data := response.json():
-                    mapping = {key: json.dumps(value) for key, value in data.items()}
-                    await redis.hset(f'due_to:{user_id}', mapping=mapping)
-                    await redis.expire(f'due_to:{user_id}', 900)
+                    with span('serialize'):
+                        mapping = {key: json.dumps(value) for key, value in data.items()}
+                    with span('cache'):
+                        await redis.hset(f'due_to:{user_id}', mapping=mapping)
+                        await redis.expire(f'due_to:{user_id}', 900)
 
                 return data # Возвращает либо словарь, либо null
 
@@ -77,7 +84,8 @@ async def get_payment_data_handler(
     try:
         async with httpx.AsyncClient() as client:
             url = PAYMENT_BASE_URL + config.payments.handler.prefix + f'/payment_data?user_id={user_id}'
-            response = await client.get(url, timeout=5.0)
+            with span('upstream'):
+                response = await client.get(url, timeout=5.0)
             return response.json()
 
     except Exception as e:
@@ -92,7 +100,8 @@ async def get_yookassa_link_handler(
     try:
         async with httpx.AsyncClient() as client:
             url = PAYMENT_BASE_URL + config.payments.handler.prefix + f'/link?user_id={user_id}'
-            response = await client.get(url, timeout=5.0)
+            with span('upstream'):
+                response = await client.get(url, timeout=5.0)
             return response.json()
 
     except Exception as e:
@@ -105,12 +114,16 @@ async def create_payment(user_data: Payment):
     try:
         async with httpx.AsyncClient() as client:
             url = PAYMENT_BASE_URL + config.payments.handler.prefix + "/add"
-            response = await client.post(
-                url=url,
-                json=user_data.model_dump(),
-                timeout=10.0
-            )
-            await redis.delete(f'due_to:{user_data.user_id}')
+            with span('serialize'):
+                payload = user_data.model_dump()
+            with span('upstream'):
+                response = await client.post(
+                    url=url,
+                    json=payload,
+                    timeout=10.0
+                )
+            with span('cache'):
+                await redis.delete(f'due_to:{user_data.user_id}')
             if response.status_code == 200:
                 logger.info(f"Successfully posted: {response.status_code}")
                 return {"status": "success"}
@@ -129,11 +142,12 @@ async def deactivate_subscription_handler(user_data: dict):
             url = PAYMENT_BASE_URL + config.payments.handler.prefix
             url += '/activate' if user_data.get('activate') else '/deactivate'
 
-            resp = await client.post(
-                url=url,
-                json=user_data,
-                timeout=10.0
-            )
+            with span('upstream'):
+                resp = await client.post(
+                    url=url,
+                    json=user_data,
+                    timeout=10.0
+                )
             if resp.status_code == 200:
                 logger.info(f"Successfully stopped subscription: {resp.status_code}")
                 return {"status": "success"}
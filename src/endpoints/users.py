@@ -11,6 +11,7 @@ from redis.asyncio import Redis as aioredis
 
 from src.config import config
 from src.models import User, Payment, Profile
+from src.tracing import TracedRoute, span
 
 DATABASE_BASE_URL = f"http://{config.database.host}:{config.database.port}"
 PAYMENT_BASE_URL = f"http://{config.payments.host}:{config.payments.port}"
@@ -21,7 +22,7 @@ logger.setLevel(logging.INFO)
 
 redis = aioredis.from_url("redis://redis")
 
-router = APIRouter(prefix='/api')
+router = APIRouter(prefix='/api', route_class=TracedRoute)
 
 
 @router.get('/check_profile')
@@ -33,7 +34,8 @@ async def check_profile_exists(
         url = DATABASE_BASE_URL + config.database.prefix + \
               f'/profile_exists?user_id={user_id}'
 
-        resp = await client.get(url=url)
+        with span('upstream'):
+            resp = await client.get(url=url)
         if resp.status_code == 200:
             profile_exists = resp.json()
             logger.info(f'profile exists: {profile_exists}')
@@ -51,7 +53,8 @@ async def check_nickname_exists(
         url = DATABASE_BASE_URL + config.database.prefix + \
               f'/nickname_exists?nickname={nickname}'
 
-        resp = await client.get(url=url, timeout=5.0)
+        with span('upstream'):
+            resp = await client.get(url=url, timeout=5.0)
         if resp.status_code == 200:
             nickname_exists = resp.json()
             logger.info(f'nickname exists: {nickname_exists}')
@@ -70,27 +73,33 @@ async def get_user_via_gateway(
         async with (httpx.AsyncClient() as client):
             url = DATABASE_BASE_URL + config.database.prefix + \
                 f'/user_exists?user_id={user_id}'
-            resp = await client.get(url=url, timeout=5.0)
+            with span('upstream'):
+                resp = await client.get(url=url, timeout=5.0)
             if resp.status_code == 200:
                 return resp.json()
             raise HTTPException(status_code=resp.status_code, detail=resp.text)
 
-    cached = await redis.hgetall(f'user:{user_id}:{target_field}')
+    with span('cache'):
+        cached = await redis.hgetall(f'user:{user_id}:{target_field}')
     if cached:
-        return {key: loads(val) for key, val in cached.items()}
+        with span('serialize'):
+            return {key: loads(val) for key, val in cached.items()}
 
     try:
         async with httpx.AsyncClient() as client:
             url = DATABASE_BASE_URL + config.database.prefix + \
                   f"/users?user_id={user_id}&target_field={target_field}"
-            resp = await client.get(
-                url=url,
-                timeout=5.0
-            )
+            with span('upstream'):
+                resp = await client.get(
+                    url=url,
+                    timeout=5.0
+                )
             if resp.status_code == 200:
                 data = resp.json()
-                mapping = {key: json.dumps(value) for key, value in data.items()}
-                await redis.hset(f'user:{user_id}:{target_field}', mapping=mapping)
+                with span('serialize'):
+                    mapping = {key: json.dumps(value) for key, value in data.items()}
+                with span('cache'):
+                    await redis.hset(f'user:{user_id}:{target_field}', mapping=mapping)
                 return data
 
             return None
@@ -107,24 +116,31 @@ async def create_user_via_gateway(user_data: User):
             # 1. Создание пользователя в базе данных
             database_url = DATABASE_BASE_URL + f"{config.database.prefix}/users"
             headers = {"Content-Type": "application/json"}
-            resp = await client.post(
-                url=database_url,
-                headers=headers,
-                content=user_data.model_dump_json(),
-                timeout=10.0
-            )
-            await redis.delete(f'user:{user_data.user_id}')
+            with span('serialize'):
+                content = user_data.model_dump_json()
+            with span('upstream'):
+                resp = await client.post(
+                    url=database_url,
+                    headers=headers,
+                    content=content,
+                    timeout=10.0
+                )
+            with span('cache'):
+                await redis.delete(f'user:{user_data.user_id}')
             logger.info(f"Successfully posted to database: {resp.status_code}")
 
             # 2. Создание платежа в платежном сервисе
             payment_url = PAYMENT_BASE_URL + f"{config.payments.handler.prefix}/add"
             default_payment = Payment(user_id=user_data.user_id)
-            resp = await client.post(
-                url=payment_url,
-                headers=headers,
-                content=default_payment.model_dump_json(),
-                timeout=10.0
-            )
+            with span('serialize'):
+                content = default_payment.model_dump_json()
+            with span('upstream'):
+                resp = await client.post(
+                    url=payment_url,
+                    headers=headers,
+                    content=content,
+                    timeout=10.0
+                )
             logger.info(f"Successfully posted to payment service: {resp.status_code}")
 
             return {"status": "success"}
@@ -144,26 +160,34 @@ async def update_user_profile(
             async with httpx.AsyncClient() as client:
                 database_url = DATABASE_BASE_URL + f"{config.database.prefix}/users"
                 headers = {"Content-Type": "application/json"}
-                resp = await client.post(
-                    url=database_url,
-                    headers=headers,
-                    json=updated_data.model_dump(),
-                    timeout=10.0
-                )
+                with span('serialize'):
+                    payload = updated_data.model_dump()
+                with span('upstream'):
+                    resp = await client.post(
+                        url=database_url,
+                        headers=headers,
+                        json=payload,
+                        timeout=10.0
+                    )
                 logger.info(f"Successfully updated user: {resp.status_code}")
-                await redis.delete(f'user:{updated_data.user_id}:users')
+                with span('cache'):
+                    await redis.delete(f'user:{updated_data.user_id}:users')
         else:
             async with httpx.AsyncClient() as client:
                 database_url = DATABASE_BASE_URL + f"{config.database.prefix}/profiles"
                 headers = {"Content-Type": "application/json"}
-                resp = await client.post(
-                    url=database_url,
-                    headers=headers,
-                    json=updated_data.model_dump(),
-                    timeout=10.0
-                )
+                with span('serialize'):
+                    payload = updated_data.model_dump()
+                with span('upstream'):
+                    resp = await client.post(
+                        url=database_url,
+                        headers=headers,
+                        json=payload,
+                        timeout=10.0
+                    )
                 logger.info(f"Successfully updated profile: {resp.status_code}")
-                await redis.delete(f'user:{updated_data.user_id}:profiles')
+                with span('cache'):
+                    await redis.delete(f'user:{updated_data.user_id}:profiles')
 
     except Exception as e:
         logger.error(f"Failed to update DB: {e}")
@@ -5,9 +5,11 @@ from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
 from src.config import config
+from src.endpoints.debug import router as debug_endpoints_router
 from src.endpoints.dictionary import router as dictionary_endpoints_router
 from src.endpoints.payments import router as payment_endpoints_router
 from src.endpoints.users import router as user_endpoints_router
+from src.tracing import TracingMiddleware
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,10 +28,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if config.tracing.enabled:
+    app.add_middleware(
+        TracingMiddleware, # noqa
+        slow_request_ms=config.tracing.slow_request_ms,
+        server_timing=config.tracing.server_timing,
+    )
 
 app.include_router(user_endpoints_router)
 app.include_router(payment_endpoints_router)
 app.include_router(dictionary_endpoints_router)
+if config.tracing.profiler_enabled:
+    app.include_router(debug_endpoints_router)
 
 if __name__ == '__main__':
     uvicorn.run(
@@ -0,0 +1,238 @@
+import inspect
+import logging
+import sys
+import time
+from collections import Counter
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from fastapi.routing import APIRoute
+
+logger = logging.getLogger('gateway')
+
+
+class _Trace:
+    """
+    Фазы текущего запроса: имя -> [суммарное время, число вызовов],
+    и отметки времени начала запроса, входа и выхода из обработчика
+    и отправки заголовков ответа.
+    После отправки ответа трассировка закрывается, и фоновые задачи
+    (BackgroundTasks) в неё уже не попадают.
+    """
+    __slots__ = ('spans', 'active', 'started', 'handler_started', 'handler_finished', 'responded')
+
+    def __init__(self, started: float):
+        self.spans: Dict[str, List[float]] = {}
+        self.active = True
+        self.started = started
+        self.handler_started: Optional[float] = None
+        self.handler_finished: Optional[float] = None
+        self.responded: Optional[float] = None
+
+
+# None означает, что трассировка выключена и span() ничего не делает
+_trace: ContextVar[Optional[_Trace]] = ContextVar('trace', default=None)
+
+_NOOP = nullcontext()
+
+
+class _Span:
+    """ Замеряет время одной фазы и добавляет его к спанам запроса """
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace: _Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.trace.active:
+            return False
+        elapsed = perf_counter() - self.started
+        entry = self.trace.spans.get(self.name)
+        if entry is None:
+            self.trace.spans[self.name] = [elapsed, 1]
+        else:
+            entry[0] += elapsed
+            entry[1] += 1
+        return False
+
+
+def span(name: str):
+    """
+    Контекстный менеджер фазы запроса (cache, upstream, serialize).
+    Без активной трассировки возвращает общий пустой менеджер.
+    """
+    trace = _trace.get()
+    if trace is None or not trace.active:
+        return _NOOP
+    return _Span(trace, name)
+
+
+def _timed_endpoint(endpoint):
+    """ Оборачивает обработчик, отмечая в трассировке вход и выход из него """
+
+    def enter() -> Optional[_Trace]:
+        trace = _trace.get()
+        if trace is None or not trace.active:
+            return None
+        trace.handler_started = perf_counter()
+        return trace
+
+    if inspect.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def timed(*args, **kwargs):
+            trace = enter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                if trace is not None:
+                    trace.handler_finished = perf_counter()
+    else:
+        @wraps(endpoint)
+        def timed(*args, **kwargs):
+            trace = enter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                if trace is not None:
+                    trace.handler_finished = perf_counter()
+
+    return timed
+
+
+class TracedRoute(APIRoute):
+    """
+    Маршрут, замеряющий вызов обработчика. Всё до него — разбор и валидация
+    запроса (Pydantic), всё после — кодирование ответа в JSON.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+
+def _phases(trace: _Trace, total: float) -> List[Tuple[str, float, Optional[int]]]:
+    """
+    Фазы запроса: (имя, время, число вызовов). validation длится до входа
+    в обработчик, encode — от выхода из него до отправки заголовков ответа.
+    Если обработчик не вызывался (404, 422), остаток считается как framework.
+    """
+    phases = []
+    handled = trace.handler_started is not None and trace.handler_finished is not None
+    if handled:
+        phases.append(('validation', trace.handler_started - trace.started, None))
+        phases.append(('handler', trace.handler_finished - trace.handler_started, None))
+    phases += [(name, elapsed, count) for name, (elapsed, count) in trace.spans.items()]
+    if handled:
+        responded = trace.responded if trace.responded is not None else trace.started + total
+        phases.append(('encode', responded - trace.handler_finished, None))
+    else:
+        other = total - sum(elapsed for elapsed, _ in trace.spans.values())
+        phases.append(('framework', max(other, 0.0), None))
+    return phases
+
+
+def _format_phases(trace: _Trace, total: float) -> str:
+    return ' '.join(
+        f'{name}={elapsed * 1000:.1f}ms' + (f'/{count}' if count else '')
+        for name, elapsed, count in _phases(trace, total)
+    )
+
+
+def _server_timing(trace: _Trace, total: float) -> bytes:
+    metrics = [f'{name};dur={elapsed * 1000:.1f}' for name, elapsed, _ in _phases(trace, total)]
+    metrics.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(metrics).encode('latin-1')
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware, собирающее спаны по фазам для каждого запроса.
+    Пишет в лог запросы, которые дольше slow_request_ms. Заголовок
+    Server-Timing раскрывает внутренние фазы любому клиенту (CORS открыт),
+    поэтому отдаётся только при server_timing.
+    """
+
+    def __init__(self, app, slow_request_ms: float, server_timing: bool = False):
+        self.app = app
+        self.slow_threshold = slow_request_ms / 1000
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        started = perf_counter()
+        trace = _Trace(started)
+        total = None
+
+        async def send_with_timing(message):
+            nonlocal total
+            if message['type'] == 'http.response.start':
+                trace.responded = perf_counter()
+                if self.server_timing:
+                    headers = list(message.get('headers', []))
+                    headers.append(
+                        (b'server-timing', _server_timing(trace, trace.responded - started))
+                    )
+                    message = {**message, 'headers': headers}
+            elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+                # Ответ отправлен: всё, что дальше (фоновые задачи), к запросу не относится
+                total = perf_counter() - started
+                trace.active = False
+            await send(message)
+
+        token = _trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _trace.reset(token)
+            trace.active = False
+            if total is None:
+                total = perf_counter() - started
+            if total >= self.slow_threshold:
+                logger.warning(
+                    f'Slow request {scope["method"]} {scope["path"]}: '
+                    f'{total * 1000:.1f}ms ({_format_phases(trace, total)})'
+                )
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f'{scope["method"]} {scope["path"]}: '
+                    f'{total * 1000:.1f}ms ({_format_phases(trace, total)})'
+                )
+
+
+def _fold_stack(frame) -> str:
+    """ Стек в формате folded (корень;...;лист), понятном flamegraph.pl и speedscope """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> Counter:
+    """
+    Снимает стек потока thread_id каждые interval секунд в течение seconds.
+    Запускается в отдельном потоке, чтобы не блокировать event loop.
+    """
+    stacks = Counter()
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[_fold_stack(frame)] += 1
+        del frame
+        time.sleep(interval)
+    return stacks
+
+
+def render_folded(stacks: Counter) -> str:
+    return '\n'.join(f'{stack} {count}' for stack, count in stacks.most_common())